@@ -2,15 +2,17 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import contextlib
 import logging
 import re
 import sys
-import time
 from dataclasses import dataclass
-from typing import Iterable, List, Optional
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from lxml import etree
+from lxml import html as lxml_html
 import mysql.connector
 from mysql.connector import errorcode
 
@@ -21,15 +23,40 @@ DEFAULT_DB_USER = "root"
 DEFAULT_DB_HOST = "localhost"
 DEFAULT_DB_PORT = 3306
 PAGE_SIZE = 25
+PAGE_ENCODING = "utf-8"
 DEFAULT_LIMIT = 250
+MAX_CONCURRENT_REQUESTS = 4
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+STORE_BATCH_SIZE = 50
 USER_AGENT = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
     "AppleWebKit/537.36 (KHTML, like Gecko) "
     "Chrome/124.0.0.0 Safari/537.36"
 )
 
+_RATING_COUNT_RE = re.compile(r"(\d+)")
+_YEAR_RE = re.compile(r"(\d{4})")
+# Tokens between delimiters, trimmed of surrounding whitespace by the pattern itself.
+_SLASH_TOKEN_RE = re.compile(r"[^/\s](?:[^/]*[^/\s])?")
+_REGION_TOKEN_RE = re.compile(r"[^,\s](?:[^, ]*[^,\s])?")
+_GENRE_TOKEN_RE = re.compile(r"\S(?:[^ ]*\S)?")
 
-@dataclass
+# Douban always serves UTF-8, so skip libxml2's charset sniffing.
+_HTML_PARSER = lxml_html.HTMLParser(encoding=PAGE_ENCODING)
+
+_XP_ITEMS = etree.XPath('//ol[@class="grid_view"]/li')
+_XP_RANK = etree.XPath('.//div[@class="pic"]//em/text()', smart_strings=False)
+_XP_TITLES = etree.XPath('.//div[@class="hd"]//span[@class="title"]/text()', smart_strings=False)
+_XP_LINK = etree.XPath('.//div[@class="hd"]//a')
+_XP_POSTER = etree.XPath('.//div[@class="pic"]//img/@src', smart_strings=False)
+_XP_RATING = etree.XPath('.//div[@class="star"]//span[@class="rating_num"]/text()', smart_strings=False)
+_XP_RATING_PEOPLE = etree.XPath('(.//div[@class="star"]//span)[last()]')
+_XP_QUOTE = etree.XPath('.//div[@class="bd"]//span[@class="inq"]')
+_XP_INFO = etree.XPath('(.//div[@class="bd"]//p)[1]')
+
+
+@dataclass(slots=True, frozen=True)
 class Movie:
     rank: int
     title: str
@@ -46,19 +73,45 @@ class Movie:
     actors: List[str]
 
 
-def fetch_html(start: int, session: Optional[requests.Session] = None) -> str:
+async def fetch_html_async(client: httpx.AsyncClient, start: int) -> bytes:
     params = {"start": start, "filter": ""}
+    attempt = 0
+    while True:
+        logging.debug("Fetching %s with params %s", BASE_URL, params)
+        try:
+            response = await client.get(BASE_URL, params=params)
+            response.raise_for_status()
+            return response.content
+        except httpx.TransportError as exc:
+            if attempt == MAX_RETRIES:
+                raise
+            backoff = RETRY_BACKOFF * (2 ** attempt)
+            logging.warning(
+                "Fetching start=%s failed (%s); retrying in %.1fs", start, exc, backoff
+            )
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+
+def _create_client() -> httpx.AsyncClient:
+    # A single HTTP/2 connection multiplexes every concurrent page request.
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENT_REQUESTS,
+        max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+        keepalive_expiry=30,
+    )
+    # httpx only advertises br when the brotli decoder is installed.
     headers = {"User-Agent": USER_AGENT}
-    sess = session or requests.Session()
-    logging.debug("Fetching %s with params %s", BASE_URL, params)
-    response = sess.get(BASE_URL, params=params, headers=headers, timeout=10)
-    response.raise_for_status()
-    return response.text
+    return httpx.AsyncClient(http2=True, headers=headers, limits=limits, timeout=10.0)
 
 
-def parse_movies(html: str) -> Iterable[Movie]:
-    soup = BeautifulSoup(html, "html.parser")
-    for item in soup.select(".grid_view li"):
+def parse_movies(html: bytes) -> Iterable[Movie]:
+    try:
+        tree = lxml_html.fromstring(html, parser=_HTML_PARSER)
+    except etree.ParserError as exc:
+        logging.warning("Skipping page due to parse error: %s", exc)
+        return
+    for item in _XP_ITEMS(tree):
         try:
             yield _parse_movie(item)
         except Exception as exc:  # pragma: no cover - defensive parsing
@@ -66,52 +119,59 @@ def parse_movies(html: str) -> Iterable[Movie]:
 
 
 def _parse_movie(item) -> Movie:
-    def _required_text(selector: str) -> str:
-        tag = item.select_one(selector)
-        if not tag:
-            raise ValueError(f"Missing required element for selector '{selector}'")
-        return tag.get_text(strip=True)
+    def _required_text(xpath: etree.XPath) -> str:
+        values = xpath(item)
+        if not values:
+            raise ValueError(f"Missing required element for XPath '{xpath.path}'")
+        return values[0].strip()
 
-    def _optional_text(selector: str) -> Optional[str]:
-        tag = item.select_one(selector)
-        return tag.get_text(strip=True) if tag else None
+    def _element_text(element) -> str:
+        return element.text_content().strip()
 
-    rank_text = _required_text(".pic em")
+    rank_text = _required_text(_XP_RANK)
     rank = int(rank_text)
 
-    title_tags = item.select(".info .hd .title")
-    title = title_tags[0].get_text(strip=True) if title_tags else _required_text(".info .hd a")
-    original_title = title_tags[1].get_text(strip=True) if len(title_tags) > 1 else None
+    detail_links = _XP_LINK(item)
+    title_texts = [text.strip() for text in _XP_TITLES(item)]
+    if title_texts:
+        title = title_texts[0]
+    elif detail_links:
+        title = _element_text(detail_links[0])
+    else:
+        raise ValueError(f"Missing required element for XPath '{_XP_LINK.path}'")
+    original_title = title_texts[1] if len(title_texts) > 1 else None
 
-    detail_link = item.select_one(".info .hd a")
-    if not detail_link or not detail_link.get("href"):
+    if not detail_links or not detail_links[0].get("href"):
         raise ValueError("Missing detail URL")
-    detail_url = detail_link["href"]
+    detail_url = detail_links[0].get("href")
 
-    poster_tag = item.select_one(".pic img")
-    poster_url = poster_tag.get("src") if poster_tag and poster_tag.get("src") else ""
+    poster_urls = _XP_POSTER(item)
+    poster_url = poster_urls[0] if poster_urls else ""
 
-    rating_text = _required_text(".star .rating_num")
+    rating_text = _required_text(_XP_RATING)
     rating = float(rating_text)
 
-    rating_spans = item.select(".star span")
+    rating_spans = _XP_RATING_PEOPLE(item)
     if not rating_spans:
         raise ValueError("Missing rating count")
-    rating_people_text = rating_spans[-1].get_text(strip=True)
-    rating_count_match = re.search(r"(\d+)", rating_people_text.replace(",", ""))
+    rating_people_text = _element_text(rating_spans[0])
+    rating_count_match = _RATING_COUNT_RE.search(rating_people_text.replace(",", ""))
     rating_count = int(rating_count_match.group(1)) if rating_count_match else 0
 
-    quote = _optional_text(".info .bd .inq")
+    quote_tags = _XP_QUOTE(item)
+    quote = _element_text(quote_tags[0]) if quote_tags else None
 
-    info_block = item.select_one(".info .bd p")
+    info_blocks = _XP_INFO(item)
     directors: List[str] = []
     actors: List[str] = []
     regions: List[str] = []
     genres: List[str] = []
     year: Optional[int] = None
 
-    if info_block:
-        info_lines = [line.strip() for line in info_block.get_text("\n").split("\n") if line.strip()]
+    if info_blocks:
+        # Split on text-node boundaries (e.g. around <br>), not on source formatting.
+        info_text = "\n".join(info_blocks[0].itertext())
+        info_lines = [line.strip() for line in info_text.split("\n") if line.strip()]
         if info_lines:
             credits_line = info_lines[0]
             directors, actors = _parse_credits(credits_line)
@@ -149,25 +209,25 @@ def _parse_credits(credits_line: str) -> tuple[List[str], List[str]]:
     if "主演:" in director_part:
         director_part, actor_part = director_part.split("主演:", 1)
 
-    directors = [segment.strip() for segment in director_part.split("/") if segment.strip()]
-    actors = [segment.strip() for segment in actor_part.split("/") if segment.strip()]
+    directors = _SLASH_TOKEN_RE.findall(director_part)
+    actors = _SLASH_TOKEN_RE.findall(actor_part)
     return directors, actors
 
 
 def _parse_meta(meta_line: str) -> tuple[Optional[int], List[str], List[str]]:
-    parts = [part.strip() for part in meta_line.split("/") if part.strip()]
+    parts = _SLASH_TOKEN_RE.findall(meta_line)
     year: Optional[int] = None
     regions: List[str] = []
     genres: List[str] = []
 
     if parts:
-        year_match = re.search(r"(\d{4})", parts[0])
+        year_match = _YEAR_RE.search(parts[0])
         if year_match:
             year = int(year_match.group(1))
     if len(parts) >= 2:
-        regions = [region.strip() for region in re.split(r"[, ]+", parts[1]) if region.strip()]
+        regions = _REGION_TOKEN_RE.findall(parts[1])
     if len(parts) >= 3:
-        genres = [genre.strip() for genre in parts[2].split(" ") if genre.strip()]
+        genres = _GENRE_TOKEN_RE.findall(parts[2])
 
     return year, regions, genres
 
@@ -230,25 +290,47 @@ def init_db(connection) -> None:
     connection.commit()
 
 
-def store_movies(connection, movies: Iterable[Movie]) -> None:
-    cursor = connection.cursor()
-    for movie in movies:
-        cursor.execute(
-            """
-            INSERT INTO movies (
-                rank, title, original_title, year, rating, rating_count,
-                quote, poster_url, detail_url
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                rank=VALUES(rank),
-                title=VALUES(title),
-                original_title=VALUES(original_title),
-                year=VALUES(year),
-                rating=VALUES(rating),
-                rating_count=VALUES(rating_count),
-                quote=VALUES(quote),
-                poster_url=VALUES(poster_url)
-            """,
+MOVIE_UPSERT_SQL = """
+    INSERT INTO movies (
+        rank, title, original_title, year, rating, rating_count,
+        quote, poster_url, detail_url
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        rank=VALUES(rank),
+        title=VALUES(title),
+        original_title=VALUES(original_title),
+        year=VALUES(year),
+        rating=VALUES(rating),
+        rating_count=VALUES(rating_count),
+        quote=VALUES(quote),
+        poster_url=VALUES(poster_url)
+"""
+
+
+@contextlib.contextmanager
+def _transaction(connection) -> Iterator[Tuple[object, object]]:
+    with contextlib.ExitStack() as cursors:
+        cursor = cursors.enter_context(contextlib.closing(connection.cursor()))
+        # Row-at-a-time statements go through a prepared cursor so they are parsed once.
+        prepared_cursor = cursors.enter_context(
+            contextlib.closing(connection.cursor(prepared=True))
+        )
+
+        connection.start_transaction()
+        try:
+            yield cursor, prepared_cursor
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+
+def _store_batch(cursor, prepared_cursor, movies: List[Movie]) -> None:
+    # Key by detail URL so a movie repeated across pages is written once.
+    unique_movies = {movie.detail_url: movie for movie in movies}
+    cursor.executemany(
+        MOVIE_UPSERT_SQL,
+        [
             (
                 movie.rank,
                 movie.title,
@@ -259,65 +341,156 @@ def store_movies(connection, movies: Iterable[Movie]) -> None:
                 movie.quote,
                 movie.poster_url,
                 movie.detail_url,
-            ),
-        )
+            )
+            for movie in unique_movies.values()
+        ],
+    )
 
-        movie_id = cursor.lastrowid
-        if not movie_id:
-            cursor.execute("SELECT id FROM movies WHERE detail_url = %s", (movie.detail_url,))
-            row = cursor.fetchone()
-            if not row:
-                raise RuntimeError(f"Failed to retrieve movie id for {movie.title}")
-            movie_id = row[0]
+    movie_ids = _fetch_movie_ids(cursor, list(unique_movies))
+    for movie in unique_movies.values():
+        if movie.detail_url not in movie_ids:
+            raise RuntimeError(f"Failed to retrieve movie id for {movie.title}")
 
-        _replace_values(cursor, "movie_regions", movie_id, "region", movie.regions)
-        _replace_values(cursor, "movie_genres", movie_id, "genre", movie.genres)
-        _replace_values(cursor, "movie_directors", movie_id, "director", movie.directors)
-        _replace_values(cursor, "movie_actors", movie_id, "actor", movie.actors)
+    def _values_by_id(attribute: str) -> Dict[int, List[str]]:
+        return {
+            movie_ids[url]: getattr(movie, attribute)
+            for url, movie in unique_movies.items()
+        }
 
-    connection.commit()
-    cursor.close()
+    _sync_values(cursor, prepared_cursor, "movie_regions", "region", _values_by_id("regions"))
+    _sync_values(cursor, prepared_cursor, "movie_genres", "genre", _values_by_id("genres"))
+    _sync_values(cursor, prepared_cursor, "movie_directors", "director", _values_by_id("directors"))
+    _sync_values(cursor, prepared_cursor, "movie_actors", "actor", _values_by_id("actors"))
+
+
+def _fetch_movie_ids(cursor, detail_urls: List[str]) -> Dict[str, int]:
+    placeholders = ", ".join(["%s"] * len(detail_urls))
+    cursor.execute(
+        f"SELECT detail_url, id FROM movies WHERE detail_url IN ({placeholders})",
+        detail_urls,
+    )
+    return dict(cursor.fetchall())
+
+
+def _sync_values(
+    cursor,
+    prepared_cursor,
+    table: str,
+    column: str,
+    values_by_movie: Dict[int, List[str]],
+) -> None:
+    # Only touch rows that changed so repeat scrapes leave the join tables alone.
+    movie_ids = list(values_by_movie)
+    placeholders = ", ".join(["%s"] * len(movie_ids))
+    cursor.execute(
+        f"SELECT movie_id, {column} FROM {table} WHERE movie_id IN ({placeholders})",
+        movie_ids,
+    )
+    existing = set(cursor.fetchall())
+    rows = [
+        (movie_id, value)
+        for movie_id, values in values_by_movie.items()
+        for value in dict.fromkeys(values)
+    ]
 
+    stale = existing.difference(rows)
+    if stale:
+        prepared_cursor.executemany(
+            f"DELETE FROM {table} WHERE movie_id = %s AND {column} = %s",
+            sorted(stale),
+        )
 
-def _replace_values(cursor, table: str, movie_id: int, column: str, values: Iterable[str]) -> None:
-    cursor.execute(f"DELETE FROM {table} WHERE movie_id = %s", (movie_id,))
-    values = list(values)
-    if not values:
+    missing = [row for row in rows if row not in existing]
+    if not missing:
         return
     cursor.executemany(
-        f"INSERT INTO {table} (movie_id, {column}) VALUES (%s, %s)",
-        [(movie_id, value) for value in values],
+        f"INSERT IGNORE INTO {table} (movie_id, {column}) VALUES (%s, %s)",
+        missing,
     )
 
 
-def scrape_top_movies(limit: int = DEFAULT_LIMIT, delay: float = 0.5) -> List[Movie]:
+async def iter_top_movies(limit: int = DEFAULT_LIMIT, delay: float = 0.5) -> AsyncIterator[Movie]:
     if limit <= 0:
         logging.warning("Requested limit %s is not positive; defaulting to %s", limit, DEFAULT_LIMIT)
         limit = DEFAULT_LIMIT
 
     limit = min(limit, DEFAULT_LIMIT)
+    starts = range(0, limit, PAGE_SIZE)
 
-    movies: List[Movie] = []
-    with requests.Session() as session:
-        for start in range(0, max(limit, PAGE_SIZE), PAGE_SIZE):
-            html = fetch_html(start, session=session)
-            page_movies = list(parse_movies(html))
-            if not page_movies:
-                logging.warning("No movies returned for start=%s; stopping early", start)
-                break
-
-            movies.extend(page_movies)
-            logging.info(
-                "Fetched movies %s-%s", start + 1, start + len(page_movies)
-            )
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    loop = asyncio.get_running_loop()
 
-            if len(movies) >= limit:
-                break
+    async def _fetch_page(client: httpx.AsyncClient, start: int) -> List[Movie]:
+        async with semaphore:
+            deadline = loop.time() + delay
+            html = await fetch_html_async(client, start)
+            # A page parses in a couple of milliseconds, so it runs inline and
+            # counts towards the politeness delay rather than adding to it.
+            page_movies = list(parse_movies(html))
 
-            if delay:
-                time.sleep(delay)
+            remaining = deadline - loop.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+        return page_movies
 
-    return movies[:limit]
+    async with _create_client() as client:
+        tasks = [asyncio.ensure_future(_fetch_page(client, start)) for start in starts]
+        try:
+            remaining = limit
+            for start, task in zip(starts, tasks):
+                page_movies = await task
+                if not page_movies:
+                    logging.warning("No movies returned for start=%s; stopping early", start)
+                    break
+
+                logging.info(
+                    "Fetched movies %s-%s", start + 1, start + len(page_movies)
+                )
+                for movie in page_movies[:remaining]:
+                    yield movie
+
+                remaining -= len(page_movies)
+                if remaining <= 0:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _store_batch_in_thread(cursor, prepared_cursor, movies: List[Movie]) -> None:
+    future = asyncio.ensure_future(
+        asyncio.to_thread(_store_batch, cursor, prepared_cursor, movies)
+    )
+    try:
+        await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # The worker thread cannot be interrupted; let it finish with the
+        # connection before the caller rolls back or closes it.
+        while not future.done():
+            try:
+                await asyncio.wait({future})
+            except asyncio.CancelledError:
+                continue
+        raise
+
+
+async def scrape_and_store(connection, limit: int = DEFAULT_LIMIT, delay: float = 0.5) -> int:
+    # One transaction for the whole stream: a failed page leaves nothing half-written.
+    stored = 0
+    batch: List[Movie] = []
+    with _transaction(connection) as (cursor, prepared_cursor):
+        async for movie in iter_top_movies(limit=limit, delay=delay):
+            batch.append(movie)
+            if len(batch) >= STORE_BATCH_SIZE:
+                await _store_batch_in_thread(cursor, prepared_cursor, batch)
+                stored += len(batch)
+                batch = []
+
+        if batch:
+            await _store_batch_in_thread(cursor, prepared_cursor, batch)
+            stored += len(batch)
+    return stored
 
 
 def main(argv: Optional[List[str]] = None) -> int:
@@ -337,16 +510,18 @@ def main(argv: Optional[List[str]] = None) -> int:
         action="store_true",
         help="Create the target database if it does not already exist",
     )
-    parser.add_argument("--delay", type=float, default=0.5, help="Delay in seconds between requests")
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0.5,
+        help="Minimum seconds each request slot is held before it is reused",
+    )
     parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT, help="Number of top movies to scrape (max 250)")
     parser.add_argument("--log-level", default="INFO", help="Logging level")
     args = parser.parse_args(argv)
 
     logging.basicConfig(level=getattr(logging, args.log_level.upper(), logging.INFO))
 
-    movies = scrape_top_movies(limit=args.limit, delay=args.delay)
-    logging.info("Parsed %d movies", len(movies))
-
     try:
         connection = connect_to_database(
             host=args.host,
@@ -362,11 +537,13 @@ def main(argv: Optional[List[str]] = None) -> int:
 
     try:
         init_db(connection)
-        store_movies(connection, movies)
+        stored = asyncio.run(
+            scrape_and_store(connection, limit=args.limit, delay=args.delay)
+        )
     finally:
         connection.close()
 
-    logging.info("Stored movies in MySQL database '%s'", args.database)
+    logging.info("Stored %d movies in MySQL database '%s'", stored, args.database)
     return 0
 
 
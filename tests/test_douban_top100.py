@@ -0,0 +1,331 @@
+import asyncio
+import random
+import re
+import threading
+import time
+
+import httpx
+import pytest
+
+from src import douban_top100
+
+
+ITEM_TEMPLATE = """
+<li>
+    <div class="item">
+        <div class="pic">
+            <em class="">{rank}</em>
+            <a href="https://movie.douban.com/subject/{rank}/">
+                <img width="100" alt="肖申克的救赎" src="https://img2.doubanio.com/p{rank}.webp" class="">
+            </a>
+        </div>
+        <div class="info">
+            <div class="hd">
+                <a href="https://movie.douban.com/subject/{rank}/" class="">
+                    <span class="title">肖申克的救赎</span>
+                    <span class="title">&nbsp;/&nbsp;The Shawshank Redemption</span>
+                    <span class="other">&nbsp;/&nbsp;月黑高飞(港)  /  刺激1995(台)</span>
+                </a>
+            </div>
+            <div class="bd">
+                <p class="">
+                    导演: 弗兰克·德拉邦特 Frank Darabont&nbsp;&nbsp;&nbsp;主演: 蒂姆·罗宾斯 Tim Robbins / 摩根·弗里曼<br>
+                    1994&nbsp;/&nbsp;美国 英国&nbsp;/&nbsp;犯罪 剧情
+                </p>
+                <div class="star">
+                    <span class="rating5-t"></span>
+                    <span class="rating_num" property="v:average">9.7</span>
+                    <span property="v:best" content="10.0"></span>
+                    <span>3,112,345人评价</span>
+                </div>
+                <p class="quote">
+                    <span class="inq">希望让人自由。</span>
+                </p>
+            </div>
+        </div>
+    </div>
+</li>
+"""
+
+
+def _page(start: int, count: int = douban_top100.PAGE_SIZE) -> bytes:
+    items = "".join(ITEM_TEMPLATE.format(rank=start + offset + 1) for offset in range(count))
+    html = (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"></head><body>'
+        f'<ol class="grid_view">{items}</ol></body></html>'
+    )
+    return html.encode("utf-8")
+
+
+class FakeCursor:
+    def __init__(self, connection, prepared=False):
+        self.connection = connection
+        self.prepared = prepared
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        self.connection.log.append(("execute", sql.split()[0], len(params)))
+        if sql.startswith("SELECT detail_url, id"):
+            self._rows = [(url, self.connection.ids.setdefault(url, len(self.connection.ids) + 1)) for url in params]
+        elif sql.startswith("SELECT movie_id"):
+            table = sql.split("FROM")[1].split()[0]
+            self._rows = [row for row in self.connection.existing.get(table, []) if row[0] in params]
+        else:
+            self._rows = []
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        self.connection.log.append(("executemany", " ".join(sql.split()[:4]), rows))
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        self.connection.log.append(("close", self.prepared))
+
+
+class FakeConnection:
+    def __init__(self, existing=None):
+        self.log = []
+        self.ids = {}
+        self.existing = existing or {}
+
+    def cursor(self, prepared=False):
+        return FakeCursor(self, prepared=prepared)
+
+    def start_transaction(self):
+        self.log.append("begin")
+
+    def commit(self):
+        self.log.append("commit")
+
+    def rollback(self):
+        self.log.append("rollback")
+
+    def upsert_batches(self):
+        return [
+            len(entry[2])
+            for entry in self.log
+            if isinstance(entry, tuple) and entry[0] == "executemany" and "INTO movies" in entry[1]
+        ]
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Route the scraper's HTTP client to an in-process handler."""
+
+    def _serve(handler):
+        monkeypatch.setattr(
+            douban_top100,
+            "_create_client",
+            lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        )
+
+    monkeypatch.setattr(douban_top100, "RETRY_BACKOFF", 0)
+    return _serve
+
+
+def _listing_handler(fail_start=None, last_start=douban_top100.DEFAULT_LIMIT):
+    def handler(request):
+        start = int(request.url.params["start"])
+        if start == fail_start:
+            return httpx.Response(500)
+        if start >= last_start:
+            return httpx.Response(200, content=b"")
+        return httpx.Response(200, content=_page(start))
+
+    return handler
+
+
+def test_parse_movies_reads_every_field():
+    movies = list(douban_top100.parse_movies(_page(0, count=2)))
+
+    assert [movie.rank for movie in movies] == [1, 2]
+    movie = movies[0]
+    assert movie.title == "肖申克的救赎"
+    assert movie.original_title == "/\xa0The Shawshank Redemption"
+    assert movie.detail_url == "https://movie.douban.com/subject/1/"
+    assert movie.poster_url == "https://img2.doubanio.com/p1.webp"
+    assert movie.rating == 9.7
+    assert movie.rating_count == 3112345
+    assert movie.quote == "希望让人自由。"
+    assert movie.directors == ["弗兰克·德拉邦特 Frank Darabont"]
+    assert movie.actors == ["蒂姆·罗宾斯 Tim Robbins", "摩根·弗里曼"]
+    assert movie.year == 1994
+    assert movie.regions == ["美国", "英国"]
+    assert movie.genres == ["犯罪", "剧情"]
+
+
+def test_parse_movies_splits_info_block_at_br_without_whitespace():
+    html = re.sub(rb"<br>\s*", b"<br>", _page(0, count=1))
+
+    (movie,) = douban_top100.parse_movies(html)
+
+    assert movie.actors == ["蒂姆·罗宾斯 Tim Robbins", "摩根·弗里曼"]
+    assert movie.year == 1994
+    assert movie.regions == ["美国", "英国"]
+    assert movie.genres == ["犯罪", "剧情"]
+
+
+@pytest.mark.parametrize("body", [b"", b"  \n\t"])
+def test_parse_movies_yields_nothing_for_empty_body(body):
+    assert list(douban_top100.parse_movies(body)) == []
+
+
+def _reference_credits(credits_line):
+    director_part = credits_line.split("导演:", 1)[1] if "导演" in credits_line else credits_line
+    actor_part = ""
+    if "主演:" in director_part:
+        director_part, actor_part = director_part.split("主演:", 1)
+    directors = [segment.strip() for segment in director_part.split("/") if segment.strip()]
+    actors = [segment.strip() for segment in actor_part.split("/") if segment.strip()]
+    return directors, actors
+
+
+def _reference_meta(meta_line):
+    parts = [part.strip() for part in meta_line.split("/") if part.strip()]
+    year = None
+    regions = []
+    genres = []
+    if parts:
+        year_match = re.search(r"(\d{4})", parts[0])
+        if year_match:
+            year = int(year_match.group(1))
+    if len(parts) >= 2:
+        regions = [region.strip() for region in re.split(r"[, ]+", parts[1]) if region.strip()]
+    if len(parts) >= 3:
+        genres = [genre.strip() for genre in parts[2].split(" ") if genre.strip()]
+    return year, regions, genres
+
+
+def test_tokenizers_match_split_based_parsing():
+    alphabet = ["/", " ", ",", "\xa0", "\t", "　", "x", "美", "主演:", "导演:", "1994"]
+    rng = random.Random(1)
+    for _ in range(20000):
+        line = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 14)))
+        try:
+            expected = _reference_credits(line)
+        except IndexError:
+            with pytest.raises(IndexError):
+                douban_top100._parse_credits(line)
+        else:
+            assert douban_top100._parse_credits(line) == expected, repr(line)
+        assert douban_top100._parse_meta(line) == _reference_meta(line), repr(line)
+
+
+def test_sync_values_only_writes_changed_rows():
+    connection = FakeConnection(existing={"movie_genres": [(1, "犯罪"), (1, "爱情"), (2, "剧情")]})
+    cursor = connection.cursor()
+    prepared_cursor = connection.cursor(prepared=True)
+
+    douban_top100._sync_values(
+        cursor, prepared_cursor, "movie_genres", "genre", {1: ["犯罪", "剧情"], 2: ["剧情"]}
+    )
+
+    writes = [entry[1:] for entry in connection.log if entry[0] == "executemany"]
+    assert writes == [
+        ("DELETE FROM movie_genres WHERE", [(1, "爱情")]),
+        ("INSERT IGNORE INTO movie_genres", [(1, "剧情")]),
+    ]
+
+
+def test_transaction_closes_cursor_when_prepared_cursor_fails():
+    connection = FakeConnection()
+
+    def cursor(prepared=False):
+        if prepared:
+            raise RuntimeError("prepared statements unavailable")
+        return FakeCursor(connection)
+
+    connection.cursor = cursor
+    with pytest.raises(RuntimeError):
+        with douban_top100._transaction(connection):
+            pass
+
+    assert connection.log == [("close", False)]
+
+
+def test_fetch_html_async_retries_transport_errors(monkeypatch):
+    monkeypatch.setattr(douban_top100, "RETRY_BACKOFF", 0)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) < 3:
+            raise httpx.ConnectError("connection reset")
+        return httpx.Response(200, content=b"<html></html>")
+
+    async def fetch():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await douban_top100.fetch_html_async(client, 0)
+
+    assert asyncio.run(fetch()) == b"<html></html>"
+    assert len(calls) == 3
+
+
+def test_iter_top_movies_stops_at_empty_page(serve):
+    serve(_listing_handler(last_start=50))
+
+    async def collect():
+        return [movie async for movie in douban_top100.iter_top_movies(limit=250, delay=0)]
+
+    movies = asyncio.run(collect())
+    assert [movie.rank for movie in movies] == list(range(1, 51))
+
+
+def test_scrape_and_store_commits_once(serve):
+    serve(_listing_handler())
+    connection = FakeConnection()
+
+    stored = asyncio.run(douban_top100.scrape_and_store(connection, limit=120, delay=0))
+
+    assert stored == 120
+    assert connection.upsert_batches() == [50, 50, 20]
+    assert connection.log[0] == "begin"
+    assert [entry for entry in connection.log if entry in ("commit", "rollback")] == ["commit"]
+
+
+def test_scrape_and_store_rolls_back_when_a_page_fails(serve):
+    serve(_listing_handler(fail_start=75))
+    connection = FakeConnection()
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(douban_top100.scrape_and_store(connection, limit=250, delay=0))
+
+    assert connection.upsert_batches() == [50]
+    assert "commit" not in connection.log
+    assert connection.log[-3:] == ["rollback", ("close", True), ("close", False)]
+
+
+def test_cancelled_scrape_waits_for_inflight_batch(monkeypatch):
+    connection = FakeConnection()
+    batch_started = threading.Event()
+
+    def slow_store_batch(cursor, prepared_cursor, movies):
+        connection.log.append("batch-start")
+        batch_started.set()
+        time.sleep(0.3)
+        connection.log.append("batch-end")
+
+    async def endless_movies(limit, delay):
+        for movie in douban_top100.parse_movies(_page(0, count=douban_top100.STORE_BATCH_SIZE)):
+            yield movie
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(douban_top100, "_store_batch", slow_store_batch)
+    monkeypatch.setattr(douban_top100, "iter_top_movies", endless_movies)
+
+    async def run_and_cancel():
+        task = asyncio.ensure_future(douban_top100.scrape_and_store(connection))
+        await asyncio.to_thread(batch_started.wait)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run_and_cancel())
+    assert [entry for entry in connection.log if isinstance(entry, str)] == [
+        "begin",
+        "batch-start",
+        "batch-end",
+        "rollback",
+    ]